@@ -1,10 +1,19 @@
+import gc
 import os
+
+# One BLAS thread per process: large regression batches run in worker processes
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from linearmodels.panel import PanelOLS
+from joblib import Parallel, delayed
+
+from fe_kernels import group_diff, run_fe_regressions
 
 DATA_PATH = "data/2013-2018renewal_empirical.dta"
+CACHE_PATH = DATA_PATH.replace(".dta", ".parquet")  # Columnar cache of the raw data
 
 # Adjust column names here if they differ from your data
 CITY_COL = "city"           # City identifier
@@ -13,6 +22,11 @@ DEP_VAR = "lhp_deflate"     # Housing price (deflated log)
 TREAT_VAR = "lnrenewal_lag" # Log of renewal intensity (lagged 1 period)
 
 OUT_DIR = "results"
+FIG_DPI = 200
+
+# Regression jobs go to worker processes only when the total number of rows
+# is at least this; below it, process start-up costs more than the fits
+PARALLEL_MIN_NOBS = 1_000_000
 
 # Font settings (Commented out SimHei as it is for Chinese support; 
 # standard fonts work fine for English)
@@ -24,75 +38,59 @@ def ensure_outdir(path=OUT_DIR):
         os.makedirs(path)
 
 
-def winsorize_series(s, lower=0.01, upper=0.99):
-    """Winsorize series by quantiles to handle outliers."""
-    q_low, q_high = s.quantile([lower, upper])
-    return s.clip(lower=q_low, upper=q_high)
+def reset_figure(fig, figsize):
+    """Clear fig, resize it and return a single fresh Axes (figures are reused)."""
+    fig.clf()
+    fig.set_size_inches(*figsize)
+    return fig.add_subplot()
 
 
-def run_fe_regression(df, dep, treat, controls=None, sample_label="full"):
+def load_panel(path=DATA_PATH, cache=CACHE_PATH):
     """
-    Run City FE + Year FE PanelOLS regression on sample df.
-    Model: y_it = beta * treat_it + gamma'X_it + mu_i + lambda_t + e_it
-    Returns a result dictionary + the original regression result object.
+    Load the raw panel, reusing a Parquet cache written on the first run.
+    The cache is rebuilt whenever the Stata file is newer than it.
     """
-    if controls is None:
-        controls = []
-
-    cols = [CITY_COL, YEAR_COL, dep, treat] + controls
-    data = df[cols].dropna().copy()
-
-    # Set panel index
-    data = data.set_index([CITY_COL, YEAR_COL]).sort_index()
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return pd.read_parquet(cache, engine="pyarrow")
 
-    y = data[dep]
-    X = data[[treat] + controls]
+    df = pd.read_stata(path)
+    # Compact key dtypes so later sorts / groupbys work on small integer codes
+    df[CITY_COL] = df[CITY_COL].astype("category")
+    df[YEAR_COL] = df[YEAR_COL].astype("int16")
+    df.to_parquet(cache, engine="pyarrow", compression="zstd")
+    return df
 
-    # Fixed Effects Model
-    mod = PanelOLS(y, X, entity_effects=True, time_effects=True)
 
-    # Fit with clustered standard errors
-    res = mod.fit(cov_type="clustered", cluster_entity=True)
-
-    coef = res.params[treat]
-    se = res.std_errors[treat]
-    pval = res.pvalues[treat]
-    ci_low = coef - 1.96 * se
-    ci_high = coef + 1.96 * se
+def winsorize_series(s, lower=0.01, upper=0.99):
+    """Winsorize series by quantiles to handle outliers."""
+    arr = s.to_numpy()
+    # nanquantile skips missing values, as Series.quantile does; the bounds are
+    # cast back to the column dtype so np.clip does not promote float32 data
+    q_low, q_high = np.nanquantile(arr, [lower, upper]).astype(arr.dtype)
+    return pd.Series(np.clip(arr, q_low, q_high), index=s.index, name=s.name)
 
-    nobs = int(res.nobs)
-    n_city = data.index.get_level_values(0).nunique()
-    n_year = data.index.get_level_values(1).nunique()
-    r2_within = res.rsquared_within
 
+def print_fe_summary(r):
+    """Print the header and estimates of one run_fe_regressions result."""
     print("\n" + "=" * 80)
-    print(f"Sample: {sample_label} | Dep Var: {dep} | Treat Var: {treat}")
+    print(f"Sample: {r['sample']} | Dep Var: {r['dep_var']} | Treat Var: {r['treat_var']}")
     print("=" * 80)
-    print(res.summary)
-
-    result_dict = {
-        "sample": sample_label,
-        "dep_var": dep,
-        "treat_var": treat,
-        "coef": coef,
-        "se": se,
-        "p": pval,
-        "ci_low": ci_low,
-        "ci_high": ci_high,
-        "nobs": nobs,
-        "n_city": n_city,
-        "n_year": n_year,
-        "r2_within": r2_within,
-    }
-
-    return result_dict, res
+    ci = f"[{r['ci_low']:.4f}, {r['ci_high']:.4f}]"
+    print(f"{'':<16}{'Coef':>10}{'Std.Err':>10}{'P-value':>10}{'95% CI':>24}")
+    print(f"{r['treat_var']:<16}{r['coef']:>10.4f}{r['se']:>10.4f}{r['p']:>10.4f}{ci:>24}")
+    print(
+        f"No. Obs: {r['nobs']} | Cities: {r['n_city']} | Years: {r['n_year']} "
+        f"| R-squared (within): {r['r2_within']:.4f}"
+    )
+    print("Effects: City, Year | Std. errors clustered by city")
+
 
 def main():
     ensure_outdir()
 
     # ---------- 1. Load Data ----------
     print(">>> Loading data...")
-    df = pd.read_stata(DATA_PATH)
+    df = load_panel()
     print("Data loaded. Shape:", df.shape)
     print("Columns:", df.columns.tolist())
 
@@ -101,131 +99,163 @@ def main():
 
     # ---------- 2. Construct Derived Variables ----------
     # 2.1 Sort by city and year
-    df = df.sort_values([CITY_COL, YEAR_COL]).copy()
+    df = df.sort_values([CITY_COL, YEAR_COL], ignore_index=True)
+
+    # City grouper shared by the steps below (key codes are computed only once;
+    # results are mapped back by city, so group order does not matter)
+    by_city = df.groupby(CITY_COL, observed=True, sort=False)
 
     # 2.2 Housing price change (difference): Δlhp_deflate_it = lhp_deflate_it - lhp_deflate_i,t-1
-    df["d_" + DEP_VAR] = df.groupby(CITY_COL)[DEP_VAR].diff()
+    # (rows are already sorted by city and year, so one pass over the codes suffices)
+    city_codes = df[CITY_COL].cat.codes.to_numpy(dtype=np.int64)
+    df["d_" + DEP_VAR] = group_diff(city_codes, df[DEP_VAR].to_numpy(dtype=np.float64))
 
     # 2.3 Construct "City Average Renewal Intensity" groups: High/Middle/Low (tercile)
-    city_avg_renewal = df.groupby(CITY_COL)[TREAT_VAR].mean()
-    q1, q2 = city_avg_renewal.quantile([0.33, 0.66])
-
-    def map_renewal_group(x):
-        if x <= q1:
-            return "low"
-        elif x <= q2:
-            return "middle"
-        else:
-            return "high"
-
-    renewal_group_map = city_avg_renewal.apply(map_renewal_group)
-    df["renewal_group"] = df[CITY_COL].map(renewal_group_map)
+    city_avg_renewal = by_city[TREAT_VAR].mean()
+    # Both cut-offs from one NumPy selection pass (NaN = city without renewal data)
+    q1, q2 = np.nanquantile(city_avg_renewal.to_numpy(), [0.33, 0.66])
+
+    # searchsorted gives 0 for x <= q1, 1 for q1 < x <= q2 and 2 otherwise
+    # (also for cities with no renewal data, whose NaN average sorts last);
+    # tied cut-offs (q1 == q2) are fine. Categories keep the alphabetical
+    # order used for the tables (high / low / middle).
+    tercile = np.searchsorted([q1, q2], city_avg_renewal.to_numpy(), side="left")
+    renewal_group_map = pd.Series(
+        pd.Categorical(
+            np.array(["low", "middle", "high"])[tercile],
+            categories=["high", "low", "middle"],
+        ),
+        index=city_avg_renewal.index,
+    )
+    df["renewal_group"] = df[CITY_COL].map(renewal_group_map).astype("category")
 
     # 2.4 Count observations per city for sample restriction (e.g., at least 3 periods)
-    city_obs_count = df.groupby(CITY_COL)[YEAR_COL].transform("count")
-    df["city_obs_count"] = city_obs_count
+    df["city_obs_count"] = by_city[YEAR_COL].transform("size")
 
     # Save processed data for inspection
-    df.to_csv(os.path.join(OUT_DIR, "panel_data_cleaned.csv"), index=False)
+    df.to_parquet(
+        os.path.join(OUT_DIR, "panel_data_cleaned.parquet"),
+        engine="pyarrow",
+        compression="zstd",
+        index=False,
+    )
 
     # ---------- 3. Descriptive Statistics ----------
     print(">>> Generating descriptive statistics...")
 
     # 3.1 General description of core variables
     desc_cols = [DEP_VAR, TREAT_VAR, "d_" + DEP_VAR]
-    desc_table = df[desc_cols].describe().T
+    desc_table = df[desc_cols].agg(["count", "mean", "std", "min", "max"]).T
+    # Quartiles for all columns from one NumPy call (same columns as describe())
+    quartiles = np.nanpercentile(df[desc_cols].to_numpy(), [25, 50, 75], axis=0)
+    for pos, (name, values) in enumerate(zip(["25%", "50%", "75%"], quartiles), start=4):
+        desc_table.insert(pos, name, values)
     desc_table.to_csv(os.path.join(OUT_DIR, "desc_core_vars.csv"))
 
-    # 3.2 Mean by year (for trend plot)
-    mean_by_year = (
-        df.groupby(YEAR_COL)[[TREAT_VAR, DEP_VAR]].mean().reset_index()
-    )
-    mean_by_year.to_csv(os.path.join(OUT_DIR, "mean_by_year.csv"), index=False)
+    # 3.2 Mean by year (for trend plot; keeps the default sort so years are in order)
+    # (kept indexed by year; to_csv writes the index as the year column)
+    mean_by_year = df.groupby(YEAR_COL, observed=True, sort=True)[[TREAT_VAR, DEP_VAR]].mean()
+    mean_by_year.to_csv(os.path.join(OUT_DIR, "mean_by_year.csv"))
 
     # 3.3 Mean by "Renewal Intensity High/Mid/Low" groups
     mean_by_group = (
-        df.groupby("renewal_group")[[TREAT_VAR, DEP_VAR]].mean().reset_index()
+        df.groupby("renewal_group", observed=True)[[TREAT_VAR, DEP_VAR]].mean().reset_index()
     )
     mean_by_group.to_csv(os.path.join(OUT_DIR, "mean_by_group.csv"), index=False)
 
+    # Panel-indexed frame with only the columns section 5 uses, built right
+    # before the flat frame is released so the two never coexist in full
+    panel_cols = [DEP_VAR, "d_" + DEP_VAR, TREAT_VAR, "renewal_group", "city_obs_count"]
+    df_mi = df.set_index([CITY_COL, YEAR_COL])[panel_cols].sort_index()
+    del df, by_city
+    gc.collect()
+
     # ---------- 4. Plot Annual Trend ----------
     print(">>> Plotting annual mean trend...")
 
-    plt.figure(figsize=(8, 4))
-    plt.plot(
-        mean_by_year[YEAR_COL],
-        mean_by_year[TREAT_VAR],
+    # One Figure object is reused for all plots below
+    fig = plt.figure()
+    ax = reset_figure(fig, (8, 4))
+    years = mean_by_year.index.to_numpy()
+    ax.plot(
+        years,
+        mean_by_year[TREAT_VAR].to_numpy(),
         marker="o",
         label=TREAT_VAR,
     )
-    plt.plot(
-        mean_by_year[YEAR_COL],
-        mean_by_year[DEP_VAR],
+    ax.plot(
+        years,
+        mean_by_year[DEP_VAR].to_numpy(),
         marker="o",
         label=DEP_VAR,
     )
-    plt.xlabel("Year")
-    plt.ylabel("Mean Value")
-    plt.title("Annual Mean Trend: Renewal Intensity vs. Housing Price (Deflated)")
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(os.path.join(OUT_DIR, "fig_trend_yearly_mean.png"), dpi=300)
-    plt.close()
+    ax.set_xlabel("Year")
+    ax.set_ylabel("Mean Value")
+    ax.set_title("Annual Mean Trend: Renewal Intensity vs. Housing Price (Deflated)")
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(os.path.join(OUT_DIR, "fig_trend_yearly_mean.png"), dpi=FIG_DPI)
 
     # ---------- 5. Regressions: Baseline + Robustness + Heterogeneity ----------
     print(">>> Running Fixed Effects regressions...")
 
-    results_list = []
+    # Independent fits are collected as (frame, specs) jobs, run in parallel
+    # worker processes for large panels; specs on the same rows share one job
+    jobs = []
 
-    # 5.1 Baseline Model: Price Level ~ Renewal Intensity (City FE + Year FE)
-    base_res_dict, base_res = run_fe_regression(
-        df, dep=DEP_VAR, treat=TREAT_VAR, controls=None, sample_label="baseline_level"
-    )
-    results_list.append(base_res_dict)
-
-    # 5.2 Robustness 1: Use price change (difference) as dependent variable
+    # Rows usable by the level regressions and by the difference regression
     d_dep = "d_" + DEP_VAR
-    d_res_dict, d_res = run_fe_regression(
-        df, dep=d_dep, treat=TREAT_VAR, controls=None, sample_label="delta_dep"
-    )
-    results_list.append(d_res_dict)
+    mask_base = df_mi[[DEP_VAR, TREAT_VAR]].notna().all(axis=1).to_numpy()
+    mask_delta = df_mi[[d_dep, TREAT_VAR]].notna().all(axis=1).to_numpy()
+    df_base = df_mi[mask_base]
 
-    # 5.3 Robustness 2: Winsorize core variables (1%-99%) before regression
-    df_w = df.copy()
-    df_w[DEP_VAR] = winsorize_series(df_w[DEP_VAR])
-    df_w[TREAT_VAR] = winsorize_series(df_w[TREAT_VAR])
+    # 5.1 Baseline Model: Price Level ~ Renewal Intensity (City FE + Year FE)
+    base_spec = dict(sample_label="baseline_level", dep=DEP_VAR, treat=TREAT_VAR)
 
-    win_res_dict, win_res = run_fe_regression(
-        df_w,
-        dep=DEP_VAR,
-        treat=TREAT_VAR,
-        controls=None,
-        sample_label="winsor_1_99",
-    )
-    results_list.append(win_res_dict)
+    # 5.3 Robustness 2: Winsorize core variables (1%-99%) before regression
+    # (cut-offs come from the full columns; clipping keeps missing values missing)
+    win_spec = dict(sample_label="winsor_1_99", dep=DEP_VAR, treat=TREAT_VAR, values={
+        DEP_VAR: winsorize_series(df_mi[DEP_VAR]).to_numpy()[mask_base],
+        TREAT_VAR: winsorize_series(df_mi[TREAT_VAR]).to_numpy()[mask_base],
+    })
 
     # 5.4 Robustness 3: Keep only cities with observation count >= 3
-    df_long = df[df["city_obs_count"] >= 3].copy()
-    long_res_dict, long_res = run_fe_regression(
-        df_long,
+    long_spec = dict(
+        sample_label="city_obs>=3",
         dep=DEP_VAR,
         treat=TREAT_VAR,
-        controls=None,
-        sample_label="city_obs>=3",
+        rows=(df_base["city_obs_count"] >= 3).to_numpy(),
     )
-    results_list.append(long_res_dict)
+
+    # 5.1 / 5.3 / 5.4 use the same columns on (subsets of) the same rows,
+    # so they are stacked into one within transform
+    jobs.append((df_base, [base_spec, win_spec, long_spec]))
+
+    # 5.2 Robustness 1: Use price change (difference) as dependent variable
+    jobs.append((df_mi[mask_delta], [dict(sample_label="delta_dep", dep=d_dep, treat=TREAT_VAR)]))
 
     # 5.5 Heterogeneity: Regressions by "High/Mid/Low" renewal groups
-    for g_name, g_df in df.groupby("renewal_group"):
+    # (boolean masks on the category codes; no groupby split needed)
+    group_codes = df_base["renewal_group"].cat.codes.to_numpy()
+    for code, g_name in enumerate(df_base["renewal_group"].cat.categories):
         label = f"hetero_renewal_{g_name}"
-        g_res_dict, g_res = run_fe_regression(
-            g_df,
-            dep=DEP_VAR,
-            treat=TREAT_VAR,
-            controls=None,
-            sample_label=label,
-        )
-        results_list.append(g_res_dict)
+        g_df = df_base[group_codes == code]
+        jobs.append((g_df, [dict(sample_label=label, dep=DEP_VAR, treat=TREAT_VAR)]))
+
+    total_nobs = sum(len(df_job) for df_job, _ in jobs)
+    n_jobs = min(len(jobs), os.cpu_count() or 1) if total_nobs >= PARALLEL_MIN_NOBS else 1
+    fits = Parallel(n_jobs=n_jobs, backend="loky")(
+        delayed(run_fe_regressions)(df_job, specs, already_clean=True) for df_job, specs in jobs
+    )
+
+    # Report in the usual order: baseline, robustness 1-3, heterogeneity
+    results_by_sample = {r["sample"]: r for batch in fits for r in batch}
+    sample_order = ["baseline_level", "delta_dep", "winsor_1_99", "city_obs>=3"]
+    sample_order += [s for s in results_by_sample if s.startswith("hetero_")]
+    results_list = [results_by_sample[s] for s in sample_order]
+    for res_dict in results_list:
+        print_fe_summary(res_dict)
+    base_res_dict = results_by_sample["baseline_level"]
 
     # ---------- 6. Save All Regression Results (for tabulation) ----------
     results_df = pd.DataFrame(results_list)
@@ -239,22 +269,21 @@ def main():
     ci_low = base_res_dict["ci_low"]
     ci_high = base_res_dict["ci_high"]
 
-    plt.figure(figsize=(6, 2.5))
+    ax = reset_figure(fig, (6, 2.5))
     y_pos = [0]  # Only one coefficient
-    plt.errorbar(
+    ax.errorbar(
         x=[coef],
         y=y_pos,
         xerr=[[coef - ci_low], [ci_high - coef]],
         fmt="o",
         capsize=5,
     )
-    plt.axvline(x=0, linestyle="--", linewidth=1)
-    plt.yticks(y_pos, [DEP_VAR])
-    plt.xlabel("Coefficient and 95% Confidence Interval")
-    plt.title(f"Estimated Effect of Renewal Intensity ({TREAT_VAR}) on Housing Price ({DEP_VAR})")
-    plt.tight_layout()
-    plt.savefig(os.path.join(OUT_DIR, "fig_coef_ci_baseline.png"), dpi=300)
-    plt.close()
+    ax.axvline(x=0, linestyle="--", linewidth=1)
+    ax.set_yticks(y_pos, [DEP_VAR])
+    ax.set_xlabel("Coefficient and 95% Confidence Interval")
+    ax.set_title(f"Estimated Effect of Renewal Intensity ({TREAT_VAR}) on Housing Price ({DEP_VAR})")
+    fig.tight_layout()
+    fig.savefig(os.path.join(OUT_DIR, "fig_coef_ci_baseline.png"), dpi=FIG_DPI)
     
 # ---------- 8. Plot "High/Mid/Low Renewal Group" Coefficient Comparison ----------
     print(">>> Plotting coefficient confidence intervals for different renewal intensity groups...")
@@ -269,8 +298,7 @@ def main():
     ci_highs = []
 
     for k in hetero_keys:
-        # Find the corresponding result dictionary in results_list
-        r = next(item for item in results_list if item["sample"] == k)
+        r = results_by_sample[k]
         coefs.append(r["coef"])
         ci_lows.append(r["ci_low"])
         ci_highs.append(r["ci_high"])
@@ -281,21 +309,21 @@ def main():
     xerr_lower = [c - cl for c, cl in zip(coefs, ci_lows)]
     xerr_upper = [ch - c for c, ch in zip(coefs, ci_highs)]
 
-    plt.figure(figsize=(6, 3))
-    plt.errorbar(
+    ax = reset_figure(fig, (6, 3))
+    ax.errorbar(
         x=coefs,
         y=y_pos,
         xerr=[xerr_lower, xerr_upper],
         fmt="o",
         capsize=5,
     )
-    plt.axvline(x=0, linestyle="--", linewidth=1)
-    plt.yticks(y_pos, hetero_labels)
-    plt.xlabel("Coefficient and 95% Confidence Interval")
-    plt.title("Estimated Effect of lnrenewal_lag by Renewal Intensity Group")
-    plt.tight_layout()
-    plt.savefig(os.path.join(OUT_DIR, "fig_coef_hetero.png"), dpi=300)
-    plt.close()
+    ax.axvline(x=0, linestyle="--", linewidth=1)
+    ax.set_yticks(y_pos, hetero_labels)
+    ax.set_xlabel("Coefficient and 95% Confidence Interval")
+    ax.set_title("Estimated Effect of lnrenewal_lag by Renewal Intensity Group")
+    fig.tight_layout()
+    fig.savefig(os.path.join(OUT_DIR, "fig_coef_hetero.png"), dpi=FIG_DPI)
+    plt.close(fig)
 
     print(">>> All analyses completed. Results output to ./results/ directory.")
 
@@ -0,0 +1,199 @@
+"""
+Numba kernels and the two-way fixed-effects estimator used by
+analysis_renewal_panel.py.
+
+They live in their own module so that joblib worker processes import them
+by reference (and pick up Numba's on-disk cache); functions defined in a
+script run as __main__ are pickled by value and recompiled in every worker.
+"""
+import numpy as np
+import pandas as pd
+from numba import njit
+from scipy import stats
+
+
+@njit(cache=True)
+def group_diff(codes, vals):
+    """
+    Within-group first difference on rows sorted by group (and time).
+    The first row of each group gets NaN, as with groupby().diff(); so do
+    rows with a missing group (code -1), which groupby() drops.
+    """
+    out = np.empty_like(vals)
+    if vals.size == 0:
+        return out
+    out[0] = np.nan
+    for i in range(1, vals.size):
+        if codes[i] >= 0 and codes[i] == codes[i - 1]:
+            out[i] = vals[i] - vals[i - 1]
+        else:
+            out[i] = np.nan
+    return out
+
+
+@njit(cache=True)
+def demean_by_group(z, gid, n_groups):
+    """
+    Subtract group means from every column of z in place.
+    gid holds group codes 0..n_groups-1; returns the largest |mean| removed.
+    NaN cells are skipped (and stay NaN), so each column is demeaned over its
+    own non-missing rows -- columns of different samples can share one call.
+    """
+    n, k = z.shape
+    sums = np.zeros((n_groups, k))
+    counts = np.zeros((n_groups, k))
+    for i in range(n):
+        g = gid[i]
+        for j in range(k):
+            if not np.isnan(z[i, j]):
+                sums[g, j] += z[i, j]
+                counts[g, j] += 1.0
+
+    max_mean = 0.0
+    for g in range(n_groups):
+        for j in range(k):
+            if counts[g, j] > 0:
+                sums[g, j] /= counts[g, j]
+                max_mean = max(max_mean, abs(sums[g, j]))
+
+    for i in range(n):
+        g = gid[i]
+        for j in range(k):
+            z[i, j] -= sums[g, j]
+    return max_mean
+
+
+@njit(cache=True)
+def two_way_demean(z, cid, tid, n_city, n_year, tol=1e-12, max_iter=10000):
+    """
+    Two-way (city + year) within transform of the columns of z, by alternating
+    projections; works for unbalanced panels and NaN-padded columns.
+    Returns a demeaned copy.
+    """
+    out = z.copy()
+    for _ in range(max_iter):
+        step_city = demean_by_group(out, cid, n_city)
+        step_year = demean_by_group(out, tid, n_year)
+        if max(step_city, step_year) < tol:
+            break
+    return out
+
+
+def warm_up_kernels():
+    """
+    Compile the Numba kernels on tiny inputs at import time, with the same
+    argument types used by the analysis script (int64 codes, float64
+    C-contiguous data), so no JIT compile happens inside the analysis.
+    With cache=True the compiled code is written to disk and loaded from
+    there by later runs. Because the kernels live in this importable module,
+    joblib workers unpickle them by reference, re-import this module and
+    load the same cached code instead of recompiling.
+    """
+    codes = np.array([0, 0, 1, 1], dtype=np.int64)
+    group_diff(codes, np.zeros(4))
+    demean_by_group(np.zeros((4, 2)), codes, 2)
+    two_way_demean(np.zeros((4, 2)), codes, np.array([0, 1, 0, 1], dtype=np.int64), 2, 2)
+
+
+warm_up_kernels()
+
+
+def run_fe_regressions(df, specs, already_clean=False):
+    """
+    Run several City FE + Year FE regressions (clustered by city) on one panel.
+    df must be indexed by (city, year), e.g. via set_index([city, year]).
+    Each spec is a dict with keys
+        sample_label              -- name reported in the result
+        dep, treat                -- dependent variable and key regressor
+        controls (optional)       -- list of extra regressors
+        rows (optional)           -- boolean mask of df rows in this sample
+        values (optional)         -- {column: array} replacing df columns
+                                     (e.g. winsorized copies)
+    All specs are stacked column-wise, NaN outside their own sample, and
+    share a single within transform. Pass already_clean=True if the caller
+    has dropped rows with missing values.
+    Model: y_it = beta * treat_it + gamma'X_it + mu_i + lambda_t + e_it
+    Estimates match linearmodels' PanelOLS(entity_effects=True, time_effects=True)
+    fitted with cov_type="clustered", cluster_entity=True (debiased, effects counted).
+    Returns a list of result dictionaries, in spec order; nothing is printed
+    here so the function can run in worker processes (see print_fe_summary()).
+    """
+    if not isinstance(df.index, pd.MultiIndex):
+        raise ValueError("df must be indexed by (city, year)")
+
+    cid = pd.factorize(df.index.get_level_values(0))[0]
+    tid = pd.factorize(df.index.get_level_values(1))[0]
+
+    # Stack [dep, treat, controls] of every spec, NaN outside the spec's rows
+    blocks, spec_rows = [], []
+    for spec in specs:
+        cols = [spec["dep"], spec["treat"]] + (spec.get("controls") or [])
+        values = spec.get("values") or {}
+        block = np.column_stack(
+            [np.asarray(values[c] if c in values else df[c], dtype=np.float64) for c in cols]
+        )
+        rows = np.ones(len(df), dtype=bool) if spec.get("rows") is None else spec["rows"].copy()
+        if not already_clean:
+            rows &= ~np.isnan(block).any(axis=1)
+        block[~rows] = np.nan
+        blocks.append(block)
+        spec_rows.append(rows)
+    z = np.ascontiguousarray(np.hstack(blocks))
+
+    z_dm = two_way_demean(z, cid, tid, cid.max() + 1, tid.max() + 1)
+    # Within R^2 is measured on city-demeaned data, as PanelOLS reports it
+    z_city = z.copy()
+    demean_by_group(z_city, cid, cid.max() + 1)
+
+    results = []
+    start = 0
+    for spec, block, rows in zip(specs, blocks, spec_rows):
+        cols = slice(start, start + block.shape[1])
+        start += block.shape[1]
+        estimates = fe_estimates(z_dm[rows, cols], z_city[rows, cols], cid[rows], tid[rows])
+        results.append({
+            "sample": spec["sample_label"],
+            "dep_var": spec["dep"],
+            "treat_var": spec["treat"],
+            **estimates,
+        })
+    return results
+
+
+def fe_estimates(z_dm, z_city, cid, tid):
+    """
+    Coefficient on column 1 of one two-way FE regression; column 0 is the
+    dependent variable. z_dm is two-way demeaned, z_city city-demeaned only.
+    """
+    # Compact city / year codes (subsamples may not use every category)
+    cid = np.unique(cid, return_inverse=True)[1]
+    n_city, n_year = cid.max() + 1, len(np.unique(tid))
+    nobs = len(z_dm)
+
+    y_dm, X_dm = z_dm[:, 0], z_dm[:, 1:]
+    params = np.linalg.lstsq(X_dm, y_dm, rcond=None)[0]
+    eps = y_dm - X_dm @ params
+
+    # City-clustered sandwich with PanelOLS' small-sample scaling
+    n_var = X_dm.shape[1]
+    df_resid = nobs - n_var - (n_city + n_year - 1)
+    scores = np.zeros((n_city, n_var))
+    np.add.at(scores, cid, X_dm * eps[:, None])
+    bread = np.linalg.inv(X_dm.T @ X_dm)
+    cov = (nobs / df_resid) * bread @ (scores.T @ scores) @ bread
+
+    coef = params[0]
+    se = np.sqrt(cov[0, 0])
+    resid_city = z_city[:, 0] - z_city[:, 1:] @ params
+
+    return {
+        "coef": coef,
+        "se": se,
+        "p": 2 * stats.t.sf(abs(coef / se), df_resid),
+        "ci_low": coef - 1.96 * se,
+        "ci_high": coef + 1.96 * se,
+        "nobs": nobs,
+        "n_city": int(n_city),
+        "n_year": n_year,
+        "r2_within": 1 - (resid_city @ resid_city) / (z_city[:, 0] @ z_city[:, 0]),
+    }